@@ -1,12 +1,17 @@
+import time
+# Chrono du démarrage, pour mesurer le temps jusqu'à la première interaction
+startTime = time.monotonic()
 import os
 import sys
 import signal
-import time
 import struct
+import pickle
+import threading
 from enum import Enum
 from functools import partial
-import serial
 import RPi.GPIO as GPIO
+import livre
+import playlist
 
 ####################################################################################################
 # Eink comm frame
@@ -35,9 +40,18 @@ def buildFrame(code, params=[]):
 
     return frame
 
+# Taille maximale des données d'une trame selon le protocole
+maxFrameData = 1024
+
 ####################################################################################################
 # Serial wrapper 
-sp = serial.Serial("/dev/serial0", baudrate = 115200, timeout=0.2)
+# L'import de pyserial et l'ouverture du port sont faits par le fil de démarrage (voir plus bas)
+sp = None
+
+def openSerial():
+    global sp
+    import serial
+    sp = serial.Serial("/dev/serial0", baudrate = 115200, timeout=0.2)
 
 def writeToSerial(frame):
     sp.write(frame)
@@ -58,6 +72,57 @@ def transactOnSerial(frame):
 
     return reply
 
+def transactBatchOnSerial(frames):
+    # Plusieurs trames en une seule écriture ; les OK sont lus trame par trame, chacun avec son
+    # propre délai d'attente. Renvoie le nombre de trames acquittées, dans l'ordre.
+    sp.write(b''.join(frames))
+
+    acknowledged = 0
+    sp.timeout = 5
+    while acknowledged < len(frames) and sp.read(2) == b'OK':
+        acknowledged += 1
+    sp.timeout = 0.2
+
+    return acknowledged
+
+def drainSerial():
+    # Laisser finir les trames encore en cours et jeter leurs réponses tardives,
+    # pour que la réponse suivante corresponde bien à la commande suivante
+    sp.timeout = 1
+    while sp.read(64) != b'':
+        pass
+    sp.timeout = 0.2
+    flushInputSerial()
+
+def sendFrames(frames):
+    # Les trames consécutives sont regroupées dans un même envoi tant qu'elles tiennent dans la
+    # limite de 1024 octets ; seules celles que le module n'a pas acquittées sont renvoyées une par une
+    batches = []
+    batch = []
+    batchLength = 0
+    for frame in frames:
+        if batch and batchLength + len(frame) > maxFrameData:
+            batches.append(batch)
+            batch = []
+            batchLength = 0
+        batch.append(frame)
+        batchLength += len(frame)
+    if batch:
+        batches.append(batch)
+
+    allOK = True
+    for batch in batches:
+        acknowledged = 0
+        if len(batch) > 1:
+            acknowledged = transactBatchOnSerial(batch)
+            if acknowledged < len(batch):
+                drainSerial()
+
+        for frame in batch[acknowledged:]:
+            allOK = transactOnSerial(frame) == bytearray(b'OK') and allOK
+
+    return allOK
+
 def readFromSerial(numberOfBytes=1):
     return sp.read(numberOfBytes)
 
@@ -158,8 +223,11 @@ def getFontSize():
 def setEnglishFontSize(size):
     return transactOnSerial(buildFrame(0x1E, [struct.pack('B', size)]))
     
+def setFontSizeFrame(size):
+    return buildFrame(0x1F, [struct.pack('B', size)])
+
 def setFontSize(size):
-    return transactOnSerial(buildFrame(0x1F, [struct.pack('B', size)]))
+    return transactOnSerial(setFontSizeFrame(size))
     
 def drawPoint(x, y):
     return transactOnSerial(buildFrame(0x20, [struct.pack('>H', x), struct.pack('>H', y)])) == bytearray(b'OK')
@@ -173,8 +241,11 @@ def fillRectangle(x1, y1, x2, y2):
 def drawRectangle(x1, y1, x2, y2):
     return transactOnSerial(buildFrame(0x25, [struct.pack('>H', x1), struct.pack('>H', y1), struct.pack('>H', x2), struct.pack('>H', y2)])) == bytearray(b'OK')
     
+def drawCircleFrame(x, y, r):
+    return buildFrame(0x26, [struct.pack('>H', x), struct.pack('>H', y), struct.pack('>H', r)])
+
 def drawCircle(x, y, r):
-    return transactOnSerial(buildFrame(0x26, [struct.pack('>H', x), struct.pack('>H', y), struct.pack('>H', r)])) == bytearray(b'OK')
+    return transactOnSerial(drawCircleFrame(x, y, r)) == bytearray(b'OK')
     
 def fillCircle(x, y, r):
     return transactOnSerial(buildFrame(0x27, [struct.pack('>H', x), struct.pack('>H', y), struct.pack('>H', r)])) == bytearray(b'OK')
@@ -185,14 +256,28 @@ def drawTriangle(x1, y1, x2, y2, x3, y3):
 def fillTriangle(x1, y1, x2, y2, x3, y3):
     return transactOnSerial(buildFrame(0x29, [struct.pack('>H', x1), struct.pack('>H', y1), struct.pack('>H', x2), struct.pack('>H', y2), struct.pack('>H', x3), struct.pack('>H', y3)])) == bytearray(b'OK')
     
+def clearFrame():
+    return buildFrame(0x2E)
+
 def clear():
-    return transactOnSerial(buildFrame(0x2E)) == bytearray(b'OK')
+    return transactOnSerial(clearFrame()) == bytearray(b'OK')
     
+def drawTextFrame(x, y, text):
+    return buildFrame(0x30, [struct.pack('>H', x), struct.pack('>H', y), livre.encodeForFont(text) + b'\x00'])
+
 def drawText(x, y, text):
-    return transactOnSerial(buildFrame(0x30, [struct.pack('>H', x), struct.pack('>H', y), bytearray(text, 'ASCII') + b'\x00'])) == bytearray(b'OK')
+    return transactOnSerial(drawTextFrame(x, y, text)) == bytearray(b'OK')
+
+def drawTextLines(x, y, lineSpacing, lines):
+    # Le protocole n'a pas de retour de ligne : une trame par ligne (les lignes vides n'en coûtent pas),
+    # envoyées ensemble par sendFrames
+    return sendFrames([ drawTextFrame(x, y + i * lineSpacing, line) for i, line in enumerate(lines) if line != '' ])
     
+def displayImageFrame(x, y, filename):
+    return buildFrame(0x70, [struct.pack('>H', x), struct.pack('>H', y), bytearray(filename, 'ASCII') + b'\x00'])
+
 def displayImage(x, y, filename):
-    return transactOnSerial(buildFrame(0x70, [struct.pack('>H', x), struct.pack('>H', y), bytearray(filename, 'ASCII') + b'\x00']))
+    return transactOnSerial(displayImageFrame(x, y, filename))
     
 def sendtoSD(filename):
     pass
@@ -205,12 +290,17 @@ GPIO.setmode(GPIO.BCM) # Système basé sur les # de GPIOs
 
 wakeupGPIO = 22
 GPIO.setup(wakeupGPIO, GPIO.OUT)
-def wakeup():
+def wakeupModule():
     GPIO.output(wakeupGPIO, 1)
     time.sleep(0.2)
     GPIO.output(wakeupGPIO, 0)
     flushInputSerial()
 
+def wakeup():
+    # Tout dessin attend la fin du démarrage en arrière-plan (port série, livre)
+    waitForStartup()
+    wakeupModule()
+
 backBTN_GPIO = 24
 fwdBTN_GPIO = 25
 goBTN_GPIO = 27
@@ -303,86 +393,251 @@ signal.signal(signal.SIGINT, signal_handler)
 ####################################################################################################
 # State
 uiState = UI_State.START_DRAW
-demoImageIndex = 0
-demoCounter = 0
 ### Livre
-# Ouvrir
-lines = []
-with open('/home/emile/Verne_Vingtmillelieuessouslesmers.txt') as book:
-    lines = [line for line in book]
-
-# Nettoyer lignes
-def sanitize(line):
-    lineNoWhitespace = line.split()
-    lineSimpleWhitespace = ' '.join(lineNoWhitespace)
-    
-    return lineSimpleWhitespace
-
-sanlines = [ sanitize(line) for line in lines ]
+bookPath = '/home/emile/Verne_Vingtmillelieuessouslesmers.txt'
+# Chargé par le fil de démarrage dans "reflowedBook", une liste de ligne cadrée sur écran EINK
+reflowedBook = None
+
+### Pages pré-rendues (optionnel, voir prerender.py)
+# Les pages sont rendues sur un PC et copiées sur la carte TF ; les manifestes P*.TXT copiés avec elles
+# sont aussi mis dans pageManifestsPath. Seules les pages qu'un manifeste annonce pour ce livre sont
+# affichées en une seule commande, les autres sont dessinées ligne par ligne.
+usePageImages = False
+pageManifestsPath = '/home/emile/carteTF'
+pagesOnCard = None
+
+if usePageImages:
+    # Importé seulement si le mode est activé
+    import prerender
+
+def findPageImages():
+    global pagesOnCard
+    pagesOnCard = prerender.findPagesOnCard(pageManifestsPath, livre.bookHash(bookPath))
+
+### Diaporama (voir playlist.py)
+# Manifeste à côté d'une copie des images ; s'il manque ou ne donne aucune image, retour à la liste
+# intégrée, qui n'a besoin que des images sur la carte
+demoManifestPath = '/home/emile/selection/diaporama.txt'
+demoImages = ['MAIS.BMP', 'KID.BMP', 'FIN23.BMP', 'L1984.BMP', 'LABO.BMP', 'LIVRES.BMP', 'LOGOS.BMP', 'MONTR.BMP', 'PIC4.BMP', 'TERRE.BMP']
+# Images refusées par le module sautées d'affilée avant d'abandonner
+maxSkippedImages = 10
+
+def makeDemoPlaylist(source):
+    return playlist.Playlist(source, mode='sequence', interval=10.0, prepare=partial(displayImageFrame, 0, 0))
+
+demoPlaylist = makeDemoPlaylist(demoManifestPath if os.path.isfile(demoManifestPath) else demoImages)
 
-# "Reflow" pour cadrer
-reflowedBook = []
-
-lenDisplay = 60
-
-for line in sanlines:
-    lenLine = len(line)
-    
-    if len(line) < lenDisplay:
-        reflowedBook.append(line)
-    else:
-        sublines = [ line[i:i+lenDisplay] for i in range(0, lenLine, lenDisplay) ]
-        for subline in sublines:
-            reflowedBook.append(subline)
-# Le livre est maintenant dans "reflowedBook", une liste de ligne cadrée sur écran EINK
+####################################################################################################
+# Démarrage rapide
+# L'écran garde sa dernière image : si elle est connue (lastScreen), l'interface accepte les boutons
+# tout de suite, et pyserial, le port série, wakeup, configSD et le livre sont chargés dans un fil en
+# arrière-plan. Le livre cadré est repris d'un instantané au lieu d'être recalculé.
+snapshotPath = '/home/emile/snapshot.pickle'
+lastScreenPath = '/home/emile/lastScreen'
+# À incrémenter si le format de l'instantané change
+snapshotVersion = 3
+
+# Le livre, et le code qui le cadre (livre.py) : toute modification de l'un ou l'autre invalide l'instantané
+def bookIdentity(path):
+    stat = os.stat(path)
+    layoutStat = os.stat(livre.__file__)
+    return (path, stat.st_size, stat.st_mtime_ns, layoutStat.st_size, layoutStat.st_mtime_ns,
+            livre.lenDisplay, snapshotVersion)
+
+# L'instantané contient deux objets : un petit en-tête lu tout de suite, puis le livre lu en arrière-plan
+def loadSnapshotHeader():
+    try:
+        snapshotFile = open(snapshotPath, 'rb')
+    except OSError:
+        return None, None
+
+    # Instantané illisible ou d'une autre version du code : ignoré, il sera refait
+    try:
+        header = pickle.load(snapshotFile)
+        valid = isinstance(header, dict) and header.get('identity') == bookIdentity(bookPath)
+    except Exception:
+        valid = False
+
+    if not valid:
+        snapshotFile.close()
+        return None, None
+
+    return snapshotFile, header
+
+def saveSnapshot(header, book):
+    temporaryPath = snapshotPath + '.tmp'
+    with open(temporaryPath, 'wb') as snapshotFile:
+        pickle.dump(header, snapshotFile)
+        pickle.dump(book, snapshotFile)
+    os.replace(temporaryPath, snapshotPath)
+
+def readLastScreen():
+    try:
+        with open(lastScreenPath, 'r') as lastScreenFile:
+            return lastScreenFile.read().strip()
+    except OSError:
+        return ''
+
+lastScreen = readLastScreen()
+
+# START ou BOOK : l'écran montre le menu ou une page. IMAGE : autre chose, il faudra redessiner
+def rememberScreen(screen):
+    global lastScreen
+    if screen == lastScreen:
+        return
+
+    with open(lastScreenPath, 'w') as lastScreenFile:
+        lastScreenFile.write(screen)
+    lastScreen = screen
+
+startupDone = threading.Event()
+startupFailed = False
+
+def startupInBackground(snapshotFile, header):
+    global reflowedBook
+    global startupFailed
+
+    try:
+        openSerial()
+        wakeupModule()
+        configSD()
+
+        if snapshotFile is not None:
+            try:
+                reflowedBook = pickle.load(snapshotFile)
+            except Exception:
+                reflowedBook = None
+            if not isinstance(reflowedBook, livre.CompactBook):
+                reflowedBook = None
+
+        if reflowedBook is None:
+            reflowedBook = livre.loadBook(bookPath)
+            # L'instantané n'est qu'un cache : s'il ne peut pas être écrit (disque plein, lecture seule...),
+            # le livre est déjà chargé et la lecture continue
+            try:
+                saveSnapshot({'identity': bookIdentity(bookPath)}, reflowedBook)
+            except OSError as error:
+                print("Instantane non enregistre :", error)
+
+        if usePageImages:
+            findPageImages()
+
+        # Le module et le livre sont prêts : la première action demandée peut être traitée
+        reportStartupTime("Pret")
+    except BaseException:
+        startupFailed = True
+        raise
+    finally:
+        if snapshotFile is not None:
+            snapshotFile.close()
+        startupDone.set()
+
+def waitForStartup():
+    startupDone.wait()
+    if startupFailed:
+        GPIO.cleanup()
+        sys.exit(1)
+
+def reportStartupTime(label):
+    print("%s en %.2f s depuis le lancement (%.2f s depuis le demarrage du noyau)"
+          % (label, time.monotonic() - startTime, time.clock_gettime(time.CLOCK_BOOTTIME)))
 
 ####################################################################################################
 # Fonctions appelées
+def compileStartMenu():
+    return [
+        clearFrame(),
+        setFontSizeFrame(3),
+        drawTextFrame(150, 50, "Prototype de livre"),
+        drawTextFrame(230, 120, "electronique"),
+        drawCircleFrame(250, 300, 30),
+        drawCircleFrame(390, 375, 30),
+        drawCircleFrame(250, 450, 30),
+        setFontSizeFrame(1),
+        drawTextFrame(300, 285, "Livre"),
+        drawTextFrame(440, 360, "Demo images"),
+        drawTextFrame(300, 435, "Eteindre (Tenir)"),
+    ]
+
 def drawStart():
     wakeup()
-    clear()
-    setFontSize(3)
-    drawText(150, 50, "Prototype de livre")
-    drawText(230, 120, "electronique")
-    drawCircle(250, 300, 30)
-    drawCircle(390, 375, 30)
-    drawCircle(250, 450, 30)
-    setFontSize(1)
-    drawText(300, 285, "Livre")
-    drawText(440, 360, "Demo images")
-    drawText(300, 435, "Eteindre (Tenir)")
+    sendFrames(menuFrames)
     refresh()
     sleep()
+    rememberScreen('START')
 
 def changeUIState(state):
     global uiState
     uiState = state
 
 def goToStartDraw():
-    global demoImageIndex
-    demoImageIndex = 0
-    global demoCounter
-    demoCounter = 0
     changeUIState(UI_State.START_DRAW)
 
 # Affect screen with IMAGE
-images = ['MAIS.BMP', 'KID.BMP', 'FIN23.BMP', 'L1984.BMP', 'LABO.BMP', 'LIVRES.BMP', 'LOGOS.BMP', 'MONTR.BMP', 'PIC4.BMP', 'TERRE.BMP']
-def wakeUpandUpdate(index):
+def wakeUpandUpdate(filename):
     wakeup()
     clear()
-    displayImage(0, 0, images[index])
+    displayImage(0, 0, filename)
     refresh()
     sleep()
+    rememberScreen('IMAGE')
+
+# Image déjà préparée par la liste de lecture : clear, la trame displayImage puis refresh,
+# seulement si le module a accepté l'image. Le clear reste nécessaire : une image plus petite
+# que l'écran (ou absente localement, donc de taille inconnue) laisserait voir la précédente.
+def wakeUpandShowPrepared(frame):
+    wakeup()
+    clear()
+    shown = transactOnSerial(frame) == bytearray(b'OK')
+    if shown:
+        refresh()
+    sleep()
+    if shown:
+        rememberScreen('IMAGE')
+    return shown
+
+def nextDemoFrame(action):
+    global demoPlaylist
+    try:
+        return action()
+    except (OSError, ValueError) as error:
+        print("Diaporama :", error, "- retour a la liste d'images integree")
+        demoPlaylist = makeDemoPlaylist(demoImages)
+        return demoPlaylist.rewind()
+
+def demoStep(step):
+    # Une image que le module refuse (absente de la carte, format) est sautée
+    for attempt in range(maxSkippedImages):
+        if wakeUpandShowPrepared(nextDemoFrame(lambda: demoPlaylist.advance(step))):
+            return
+
+def startDemo():
+    changeUIState(UI_State.DEMO)
+    if not wakeUpandShowPrepared(nextDemoFrame(lambda: demoPlaylist.rewind())):
+        demoStep(1)
+
+def displayPageImage(startPosition):
+    # Une image couvre une page entière : seulement pour une position en début de page
+    if pagesOnCard is None or startPosition % livre.linesPerPage != 0:
+        return False
+
+    tag, pageCount = pagesOnCard
+    page = livre.pageOfPosition(startPosition)
+    if page >= pageCount:
+        return False
+
+    return displayImage(0, 0, prerender.pageImageName(tag, page)) == bytearray(b'OK')
 
 def drawBookPage(startPosition):
     wakeup()
     clear()
 
-    for i in range(0, 14):
-        drawText(20, 20 + i * 40, reflowedBook[startPosition + i])
+    if not displayPageImage(startPosition):
+        drawTextLines(20, 20, 40, reflowedBook[startPosition:startPosition + 14])
 
     refresh()
     sleep()
+    rememberScreen('BOOK')
 
 def configSD():
     if not setStorageArea("SD"):
@@ -390,18 +645,37 @@ def configSD():
         sys.exit()
 
 def shutdownWithImage():
-    wakeUpandUpdate(5)
+    wakeUpandUpdate('LIVRES.BMP')
     os.system('shutdown 0')
 
 ####################################################################################################
 # Programme principal
 
-# Config initiale
-wakeup()
-configSD()
+# Config initiale : livre repris de l'instantané s'il correspond au livre ; les trames du menu
+# se recalculent en quelques microsecondes
+snapshotFile, snapshotHeader = loadSnapshotHeader()
+menuFrames = compileStartMenu()
+
+# L'écran montre encore le menu ou une page : pas besoin de redessiner pour accepter les boutons
+match lastScreen:
+    case 'START':
+        uiState = UI_State.START_WAIT
+    case 'BOOK':
+        uiState = UI_State.BOOK_WAIT
+
+threading.Thread(target=startupInBackground, args=(snapshotFile, snapshotHeader), daemon=True).start()
 
 # Boucle maître
+# Deux mesures : boutons enregistrés (écran déjà à jour), puis "Pret" quand une action peut être traitée
+buttonsReported = False
 while True:
+    if uiState in (UI_State.START_WAIT, UI_State.BOOK_WAIT):
+        if not buttonsReported:
+            reportStartupTime("Boutons enregistres")
+            buttonsReported = True
+    else:
+        waitForStartup()
+
     match uiState:
         case UI_State.START_DRAW:
             drawStart()
@@ -409,7 +683,7 @@ while True:
 
         case UI_State.START_WAIT:
             reactToLastEvent(callbackShortBack = partial(changeUIState, UI_State.BOOK_DRAW), 
-                             callbackShortFwd  = partial(changeUIState, UI_State.DEMO), 
+                             callbackShortFwd  = startDemo, 
                              callbackLongGo    = shutdownWithImage)
 
         case UI_State.BOOK_DRAW:
@@ -456,19 +730,12 @@ while True:
             changeUIState(UI_State.BOOK_DRAW)
 
         case UI_State.DEMO:
-            demoCounter += 1
-
-            if demoCounter == 1:
-                wakeUpandUpdate(demoImageIndex)
-            elif demoCounter == 40:
-                demoCounter = 0
+            if demoPlaylist.due():
+                demoStep(1)
 
-                if demoImageIndex == len(images) - 1:
-                    demoImageIndex = 0
-                else:
-                    demoImageIndex += 1
-
-            reactToLastEvent(callbackLongGo = goToStartDraw)
+            reactToLastEvent(callbackShortBack = partial(demoStep, -1),
+                             callbackShortFwd  = partial(demoStep, 1),
+                             callbackLongGo    = goToStartDraw)
 
     time.sleep(0.250)
         
@@ -0,0 +1,185 @@
+import hashlib
+import unicodedata
+from array import array
+
+####################################################################################################
+# Encodage du texte pour la police du module (utilisé par eink.py et pour cadrer le livre)
+# La police anglaise du module est ASCII : les caractères accentués des livres (é, à, ç, œ, ﬁ, ...)
+# sont ramenés à leur équivalent ASCII par une table remplie au fur et à mesure, chaque caractère
+# n'étant analysé qu'à sa première rencontre.
+fontSubstitutions = {
+    'œ': 'oe', 'Œ': 'OE', 'æ': 'ae', 'Æ': 'AE', 'ß': 'ss',
+    '«': '"', '»': '"', '“': '"', '”': '"', '„': '"',
+    '‘': "'", '’': "'", '′': "'", '″': '"',
+    '–': '-', '—': '-', '…': '...', '°': 'o', '↑': '^',
+    '¼': '1/4', '½': '1/2', '¾': '3/4',
+    '\u00a0': ' ', '\u202f': ' ',
+}
+
+def foldCharacter(char):
+    if char in fontSubstitutions:
+        return fontSubstitutions[char]
+
+    # NFKD sépare les accents et décompose les ligatures (ﬁ -> fi), quel que soit le bloc Unicode
+    decomposed = unicodedata.normalize('NFKD', char)
+    plain = decomposed.encode('ASCII', 'ignore').decode('ASCII')
+    # Seuls les accents (marques combinantes) peuvent être retirés : ½ ne doit pas devenir "12"
+    dropped = [ c for c in decomposed if not c.isascii() ]
+    if plain and all(unicodedata.category(c) == 'Mn' for c in dropped):
+        return plain
+
+    # Sans équivalent : le caractère est gardé et deviendra '?' à l'encodage
+    return char
+
+class FontTable(dict):
+    # Table pour str.translate, complétée à la première rencontre de chaque caractère
+    def __missing__(self, codepoint):
+        replacement = foldCharacter(chr(codepoint))
+        self[codepoint] = replacement
+        return replacement
+
+fontTable = FontTable()
+
+# Largeur affichée : œ, … ou ½ prennent plusieurs caractères une fois encodés
+def displayWidth(text):
+    return len(text.translate(fontTable))
+
+def encodeForFont(text):
+    # Les caractères sans équivalent deviennent '?' au lieu de faire planter l'encodage
+    return text.translate(fontTable).encode('ASCII', 'replace')
+
+####################################################################################################
+# Mise en page du livre (sans dépendance au matériel, utilisable sur un PC)
+lenDisplay = 60
+linesPerPage = 14
+# À incrémenter quand le découpage des lignes change sans que lenDisplay change :
+# les pages pré-rendues (prerender.py) en dépendent
+layoutVersion = 2
+
+# Nettoyer lignes
+def sanitize(line):
+    lineNoWhitespace = line.split()
+    lineSimpleWhitespace = ' '.join(lineNoWhitespace)
+
+    return lineSimpleWhitespace
+
+# "Reflow" pour cadrer, selon la largeur une fois encodée pour la police du module
+def reflow(sanlines, lenDisplay=lenDisplay):
+    reflowedBook = []
+
+    for line in sanlines:
+        lenLine = len(line)
+
+        if displayWidth(line) < lenDisplay:
+            reflowedBook.append(line)
+        else:
+            start = 0
+            while start < lenLine:
+                end = start + lenDisplay
+                while displayWidth(line[start:end]) > lenDisplay:
+                    end -= 1
+                reflowedBook.append(line[start:end])
+                start = end
+
+    return reflowedBook
+
+# Ancienne représentation : trois listes de chaînes (lignes, lignes nettoyées, livre cadré)
+def loadBookAsLists(path, lenDisplay=lenDisplay):
+    with open(path) as book:
+        lines = [line for line in book]
+
+    sanlines = [ sanitize(line) for line in lines ]
+
+    return reflow(sanlines, lenDisplay)
+
+####################################################################################################
+# Livre compact : un seul tampon UTF-8 et une table d'offsets de début de ligne
+# S'indexe comme la liste "reflowedBook" (livre[i], livre[a:b], len(livre)) mais sans garder une
+# chaîne Python par ligne : les chaînes ne sont créées qu'au moment d'afficher une page.
+class CompactBook:
+    def __init__(self):
+        self.buffer = bytearray()
+        self.offsets = array('L', [0])
+
+    def append(self, line):
+        self.buffer += line.encode('UTF-8')
+        self.offsets.append(len(self.buffer))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def line(self, index):
+        return self.buffer[self.offsets[index]:self.offsets[index + 1]].decode('UTF-8')
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [ self.line(i) for i in range(*index.indices(len(self))) ]
+
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError('Ligne hors du livre', index)
+
+        return self.line(index)
+
+def loadBook(path, lenDisplay=lenDisplay):
+    # Lecture en continu : une seule ligne du fichier en mémoire à la fois
+    reflowedBook = CompactBook()
+    with open(path) as book:
+        for line in book:
+            for subline in reflow([sanitize(line)], lenDisplay):
+                reflowedBook.append(subline)
+
+    return reflowedBook
+
+def bookHash(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as book:
+        for block in iter(lambda: book.read(65536), b''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+def pageOfPosition(positionInBook):
+    return positionInBook // linesPerPage
+
+def pageLines(reflowedBook, page):
+    start = page * linesPerPage
+    return reflowedBook[start:start + linesPerPage]
+
+def pageCount(reflowedBook):
+    return (len(reflowedBook) + linesPerPage - 1) // linesPerPage
+
+####################################################################################################
+# Mesure de la mémoire : python livre.py LIVRE.txt [listes|compact]
+# Lancer une fois par représentation, chaque mesure dans un processus neuf.
+# Vérification de l'encodage : python livre.py LIVRE.txt [LIVRE2.txt ...] verifier
+# Liste les caractères sans équivalent ASCII, qui s'afficheraient en '?'.
+if __name__ == '__main__':
+    # resource n'existe que sous Unix : importé ici pour que le module reste utilisable ailleurs
+    import sys
+    import resource
+
+    if len(sys.argv) < 2:
+        print("Usage : python livre.py LIVRE.txt [listes|compact]")
+        print("        python livre.py LIVRE.txt [LIVRE2.txt ...] verifier")
+        sys.exit(1)
+
+    if sys.argv[-1] == 'verifier':
+        allASCII = True
+        for path in sys.argv[1:-1]:
+            with open(path) as book:
+                unknown = sorted(set(char for char in book.read().translate(fontTable) if not char.isascii()))
+            print(path, "OK" if not unknown else ' '.join('U+%04X' % ord(char) for char in unknown))
+            allASCII = allASCII and not unknown
+        sys.exit(0 if allASCII else 1)
+
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if len(sys.argv) > 2 and sys.argv[2] == 'listes':
+        reflowedBook = loadBookAsLists(sys.argv[1])
+    else:
+        reflowedBook = loadBook(sys.argv[1])
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # ru_maxrss est en ko sous Linux
+    print("%d lignes, RSS max %d ko (livre : %d ko)" % (len(reflowedBook), after, after - before))
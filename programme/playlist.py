@@ -0,0 +1,228 @@
+import os
+import time
+import random
+from array import array
+
+####################################################################################################
+# Liste de lecture d'images pour le diaporama (sans dépendance au matériel)
+# La source est soit un dossier (copie locale des images de la carte TF, lue en ordre alphabétique),
+# soit un fichier manifeste avec un nom d'image par ligne, suivi optionnellement d'une durée en secondes,
+# soit une liste de noms :
+#     MAIS.BMP
+#     KID.BMP 20
+#     # commentaire
+# Les lignes mal formées du manifeste sont ignorées.
+# Les noms sont lus au fur et à mesure dans un tampon compact (un bytearray et une table d'offsets)
+# plutôt que dans une liste de chaînes, pour rester léger avec des milliers d'images.
+# Deux cas lisent toute la source d'un coup : un dossier (le tri demande tous les noms) et le mode
+# aléatoire (l'ordre est tiré sur toute la liste). Le manifeste et la liste restent lus à la demande.
+# La validation se fait côté Pi seulement (nom, en-tête du BMP local s'il existe) : le module ne permet
+# pas de vérifier une image sans l'afficher, c'est donc la réponse à displayImage qui fait foi.
+
+def isValidImageName(name):
+    # Le module exige un .BMP en majuscules de 10 caractères au plus (point inclus, 0 final exclu)
+    return name.isascii() and name == name.upper() and name.endswith('.BMP') and len(name) <= 10
+
+def isDisplayableBitmap(path):
+    # Le module n'affiche que des bitmaps à palette (1, 2 ou 4 bits par pixel comme dans images/selection) ;
+    # une image absente localement est acceptée puisqu'elle peut n'exister que sur la carte TF
+    try:
+        with open(path, 'rb') as image:
+            header = image.read(30)
+    except OSError:
+        return True
+
+    if len(header) < 30 or header[0:2] != b'BM':
+        return False
+
+    bitsPerPixel = int.from_bytes(header[28:30], 'little')
+    return bitsPerPixel in (1, 2, 4)
+
+class Playlist:
+    def __init__(self, source, mode='sequence', interval=10.0, prepare=lambda name: name):
+        if mode not in ('sequence', 'shuffle', 'buttons'):
+            raise ValueError('Mode must be sequence, shuffle or buttons, received : ', mode)
+
+        self.source = source
+        self.mode = mode
+        self.interval = interval
+        self.prepare = prepare
+
+        if isinstance(source, list):
+            self.directory = None
+        elif os.path.isdir(source):
+            self.directory = source
+        else:
+            self.directory = os.path.dirname(source)
+
+        self.names = bytearray()
+        self.offsets = array('L', [0])
+        self.durations = array('f')
+        self.entries = self.readEntries()
+        self.exhausted = False
+
+        self.order = None
+        self.position = 0
+        self.deadline = None
+        self.upcoming = None
+
+    ################################################################################################
+    # Lecture paresseuse de la source
+    def readEntries(self):
+        if isinstance(self.source, list):
+            for name in self.source:
+                yield name, 0.0
+        elif os.path.isdir(self.source):
+            # Lecture complète : le tri pour un ordre stable demande tous les noms du dossier
+            for name in sorted(os.listdir(self.source)):
+                if isValidImageName(name) and os.path.isfile(os.path.join(self.source, name)):
+                    yield name, 0.0
+        else:
+            with open(self.source) as manifest:
+                for line in manifest:
+                    fields = line.split()
+                    if not fields or fields[0].startswith('#') or len(fields) > 2:
+                        continue
+
+                    try:
+                        duration = float(fields[1]) if len(fields) > 1 else 0.0
+                    except ValueError:
+                        continue
+                    if duration < 0:
+                        continue
+
+                    yield fields[0], duration
+
+    def indexUpTo(self, index):
+        while len(self.durations) <= index and not self.exhausted:
+            try:
+                name, duration = next(self.entries)
+            except StopIteration:
+                self.exhausted = True
+                break
+
+            self.names += name.encode('ASCII', 'replace')
+            self.offsets.append(len(self.names))
+            self.durations.append(duration)
+
+        return index < len(self.durations)
+
+    def __len__(self):
+        while self.indexUpTo(len(self.durations)):
+            pass
+        return len(self.durations)
+
+    def entry(self, index):
+        if self.order is not None:
+            index = self.order[index]
+
+        if not self.indexUpTo(index):
+            raise IndexError('Image hors de la liste', index)
+
+        name = self.names[self.offsets[index]:self.offsets[index + 1]].decode('ASCII')
+        return name, self.durations[index] or self.interval
+
+    ################################################################################################
+    # Ordre de lecture
+    def shuffle(self):
+        previous = self.order[-1] if self.order else None
+        self.order = array('L', range(len(self)))
+        random.shuffle(self.order)
+
+        # Pas deux fois la même image à la jonction de deux tours
+        if len(self.order) > 1 and self.order[0] == previous:
+            self.order[0], self.order[-1] = self.order[-1], self.order[0]
+
+    def isValid(self, name):
+        if not isValidImageName(name):
+            return False
+        return self.directory is None or isDisplayableBitmap(os.path.join(self.directory, name))
+
+    def findValid(self, index, step, reshuffle=True):
+        # Saute les images que le module ne pourra pas afficher. Passer la fin d'un tour en mode
+        # aléatoire rebat l'ordre ; sans reshuffle, on s'arrête là et on renvoie None.
+        if not self.indexUpTo(0):
+            raise ValueError('Liste de lecture vide', self.source)
+
+        start = None
+        while True:
+            if index < 0:
+                # Avant la première image : on repart de la dernière image déjà lue, sans lire le reste
+                # de la source ; une fois la source lue en entier, c'est la dernière de la liste
+                index = len(self.durations) - 1
+            elif not self.indexUpTo(index):
+                if self.mode == 'shuffle':
+                    if not reshuffle:
+                        return None
+                    self.shuffle()
+                index = 0
+
+            if index == start:
+                raise ValueError('Aucune image affichable', self.source)
+            if start is None:
+                start = index
+
+            if self.isValid(self.entry(index)[0]):
+                return index
+            index += step
+
+    def prefetch(self, step=1):
+        # Prépare l'image suivante pour que la transition se résume à l'envoi de la trame.
+        # En fin de tour aléatoire, rien n'est préparé : l'ordre n'est rebattu qu'en avançant vraiment.
+        self.upcoming = None
+        index = self.findValid(self.position + step, step, reshuffle=False)
+        if index is not None:
+            self.upcoming = (index, step, self.prepare(self.entry(index)[0]))
+
+    ################################################################################################
+    # Avance et minuterie (horloge monotone, sans dérive)
+    def rewind(self, now=None):
+        if self.mode == 'shuffle':
+            self.shuffle()
+
+        self.deadline = None
+        self.position = self.findValid(0, 1)
+        return self.show(self.prepare(self.entry(self.position)[0]), now)
+
+    def advance(self, step=1, now=None):
+        if self.upcoming is not None and self.upcoming[1] == step:
+            self.position, _, prepared = self.upcoming
+        else:
+            self.position = self.findValid(self.position + step, step)
+            prepared = self.prepare(self.entry(self.position)[0])
+
+        return self.show(prepared, now)
+
+    def show(self, prepared, now):
+        if now is None:
+            now = time.monotonic()
+
+        duration = self.entry(self.position)[1]
+        if self.deadline is None or now < self.deadline or now - self.deadline > duration:
+            # Premier affichage, avance par bouton ou trop de retard : on repart de maintenant
+            self.deadline = now + duration
+        else:
+            self.deadline += duration
+
+        self.prefetch()
+        return prepared
+
+    def setMode(self, mode, now=None):
+        if mode not in ('sequence', 'shuffle', 'buttons'):
+            raise ValueError('Mode must be sequence, shuffle or buttons, received : ', mode)
+
+        self.mode = mode
+        if mode != 'buttons' and self.deadline is not None:
+            # En passant en mode minuté, l'image affichée a droit à sa durée complète à partir de maintenant
+            if now is None:
+                now = time.monotonic()
+            self.deadline = now + self.entry(self.position)[1]
+
+    def due(self, now=None):
+        if self.mode == 'buttons' or self.deadline is None:
+            return False
+
+        if now is None:
+            now = time.monotonic()
+
+        return now >= self.deadline
@@ -0,0 +1,178 @@
+import os
+import sys
+import hashlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import livre
+
+####################################################################################################
+# Pages de livre pré-rendues en images BMP
+# Chaque page est rendue d'avance sur un PC en bitmap 1bpp au format de l'écran, pour être affichée
+# ensuite avec une seule commande displayImage au lieu de 14 drawText.
+# Le protocole série n'a pas de commande pour envoyer un fichier au module : les images sont écrites
+# dans un dossier qui reflète la racine de la carte TF, à copier tel quel sur la carte. Chaque livre y
+# a un manifeste (P<tag>.TXT) qui dit quelles pages sont sur la carte ; une copie des manifestes sur
+# le Pi permet à eink.py de savoir quelles pages il peut afficher en image.
+# Pillow n'est nécessaire que pour le rendu.
+
+panelWidth = 800
+panelHeight = 600
+marginX = 20
+marginY = 20
+lineSpacing = 40
+
+defaultFont = '/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf'
+defaultFontSize = 24
+
+defaultCardRoot = 'carteTF'
+
+####################################################################################################
+# Noms sur la carte : (livre et mise en page -> tag, numéro de page)
+def layoutKey(fontPath=defaultFont, fontSize=defaultFontSize):
+    return '%s:%d:%d:%d:%d:%d:%d:%dx%d:v%d' % (os.path.basename(fontPath), fontSize, livre.lenDisplay, livre.linesPerPage,
+                                              marginX, marginY, lineSpacing, panelWidth, panelHeight, livre.layoutVersion)
+
+def toBase36(value, width):
+    digits = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+    text = ''
+    for i in range(width):
+        value, digit = divmod(value, 36)
+        text = digits[digit] + text
+    return text
+
+tagCount = 36 * 36
+maxPages = 36 * 36 * 36
+
+def pageImageName(tag, page):
+    # Le module exige un nom en majuscules de 10 caractères au plus (point inclus) :
+    # 2 caractères pour le livre et la mise en page, 3 pour la page (maxPages = 46656 pages au plus)
+    return toBase36(tag, 2) + toBase36(page, 3) + '.BMP'
+
+def manifestName(tag):
+    return 'P' + toBase36(tag, 2) + '.TXT'
+
+####################################################################################################
+# Manifestes : empreinte du livre, mise en page, cadrage (lenDisplay linesPerPage layoutVersion), nombre de pages
+def framing():
+    return '%d %d %d' % (livre.lenDisplay, livre.linesPerPage, livre.layoutVersion)
+
+def readManifest(path):
+    try:
+        with open(path) as manifest:
+            fields = [ line.strip() for line in manifest ]
+        return fields[0], fields[1], fields[2], int(fields[3])
+    except (OSError, IndexError, ValueError):
+        return None
+
+def writeManifest(path, bookDigest, layout, pageCount):
+    temporaryPath = path + '.tmp'
+    with open(temporaryPath, 'w') as manifest:
+        manifest.write('%s\n%s\n%s\n%d\n' % (bookDigest, layout, framing(), pageCount))
+    os.replace(temporaryPath, path)
+
+def findPagesOnCard(manifestDirectory, bookDigest):
+    # Utilisé sur le Pi : tag et nombre de pages sur la carte pour ce livre et ce cadrage, ou None.
+    # Un manifeste d'une ancienne version du découpage ne correspond plus aux positions du livre.
+    try:
+        names = set(os.listdir(manifestDirectory))
+    except OSError:
+        return None
+
+    for tag in range(tagCount):
+        if manifestName(tag) not in names:
+            continue
+
+        found = readManifest(os.path.join(manifestDirectory, manifestName(tag)))
+        if found is not None and found[0] == bookDigest and found[2] == framing():
+            return tag, found[3]
+
+    return None
+
+def chooseTag(cardRoot, bookDigest, layout):
+    # Le tag vient de l'empreinte ; s'il est déjà pris par un autre livre sur la carte, on prend le suivant
+    start = int(hashlib.sha1((bookDigest + layout).encode('UTF-8')).hexdigest(), 16) % tagCount
+    for i in range(tagCount):
+        tag = (start + i) % tagCount
+        found = readManifest(os.path.join(cardRoot, manifestName(tag)))
+        if found is None or (found[0] == bookDigest and found[1] == layout):
+            return tag
+
+    raise ValueError('Plus de tag libre sur la carte', cardRoot)
+
+####################################################################################################
+# Rendu (un processus par coeur)
+workerFont = None
+
+def initWorker(fontPath, fontSize):
+    global workerFont
+    from PIL import ImageFont
+    workerFont = ImageFont.truetype(fontPath, fontSize)
+
+def renderPage(job):
+    from PIL import Image, ImageDraw
+
+    path, lines = job
+    image = Image.new('1', (panelWidth, panelHeight), 1)
+    draw = ImageDraw.Draw(image)
+    for i, line in enumerate(lines):
+        draw.text((marginX, marginY + i * lineSpacing), line, font=workerFont, fill=0)
+
+    # Écriture atomique : une page à moitié écrite ne doit jamais passer pour une page rendue
+    temporaryPath = path + '.tmp'
+    image.save(temporaryPath, 'BMP')
+    os.replace(temporaryPath, path)
+
+    return path
+
+def renderBook(bookPath, cardRoot=defaultCardRoot, fontPath=defaultFont, fontSize=defaultFontSize, workers=None):
+    bookDigest = livre.bookHash(bookPath)
+    layout = layoutKey(fontPath, fontSize)
+    reflowedBook = livre.loadBook(bookPath)
+    pageCount = livre.pageCount(reflowedBook)
+    # Au-delà, les noms de pages reviendraient à 000 et écraseraient les premières pages
+    if pageCount > maxPages:
+        raise ValueError('Livre trop long pour les noms de pages sur la carte', pageCount, maxPages)
+
+    os.makedirs(cardRoot, exist_ok=True)
+    tag = chooseTag(cardRoot, bookDigest, layout)
+    manifestPath = os.path.join(cardRoot, manifestName(tag))
+
+    # Le tag est réservé tout de suite (0 page) ; le nombre de pages n'est écrit qu'une fois tout rendu
+    found = readManifest(manifestPath)
+    if found is None:
+        writeManifest(manifestPath, bookDigest, layout, 0)
+
+    jobs = []
+    for page in range(pageCount):
+        path = os.path.join(cardRoot, pageImageName(tag, page))
+        if found is None or not os.path.exists(path):
+            jobs.append((path, livre.pageLines(reflowedBook, page)))
+
+    if jobs:
+        # spawn : pas de fork d'un processus qui a déjà des fils d'exécution
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                                 initializer=initWorker, initargs=(fontPath, fontSize)) as executor:
+            list(executor.map(renderPage, jobs, chunksize=16))
+
+    writeManifest(manifestPath, bookDigest, layout, pageCount)
+
+    return manifestPath
+
+####################################################################################################
+# Utilisation sur un PC : python prerender.py LIVRE.txt [dossier-carte] [police.ttf] [taille]
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print("Usage : python prerender.py LIVRE.txt [dossier-carte] [police.ttf] [taille]")
+        sys.exit(1)
+
+    bookPath = sys.argv[1]
+    cardRoot = sys.argv[2] if len(sys.argv) > 2 else defaultCardRoot
+    fontPath = sys.argv[3] if len(sys.argv) > 3 else defaultFont
+    fontSize = int(sys.argv[4]) if len(sys.argv) > 4 else defaultFontSize
+
+    manifestPath = renderBook(bookPath, cardRoot, fontPath, fontSize)
+    print("Pages rendues dans", cardRoot, "- manifeste", manifestPath)
+    print("Copier le contenu du dossier a la racine de la carte TF du module,")
+    print("et les fichiers P*.TXT dans /home/emile/carteTF sur le Pi")
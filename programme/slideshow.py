@@ -1,9 +1,12 @@
+import os
 import sys
 import signal
 import time
 import struct
+from functools import partial
 import serial
 import RPi.GPIO as GPIO
+import playlist
 
 # Eink comm frame
 def buildFrame(code, params=[]):
@@ -185,8 +188,11 @@ def clear():
 def drawText(x, y, text):
     return transactOnSerial(buildFrame(0x30, [struct.pack('>H', x), struct.pack('>H', y), bytearray(text, 'ASCII') + b'\x00'])) == bytearray(b'OK')
     
+def displayImageFrame(x, y, filename):
+    return buildFrame(0x70, [struct.pack('>H', x), struct.pack('>H', y), bytearray(filename, 'ASCII') + b'\x00'])
+
 def displayImage(x, y, filename):
-    return transactOnSerial(buildFrame(0x70, [struct.pack('>H', x), struct.pack('>H', y), bytearray(filename, 'ASCII') + b'\x00']))
+    return transactOnSerial(displayImageFrame(x, y, filename))
     
 def sendtoSD(filename):
     pass
@@ -215,18 +221,52 @@ GPIO.setup(goBTN_GPIO, GPIO.IN)
 # Suivi des événements
 events = ['NOTHING']
 
-# Affect screen with IMAGE
-images = ['MAIS.BMP', 'KID.BMP', 'ZEN.BMP']
-def wakeUpandUpdate(index):
+# Liste de lecture (voir playlist.py) : dossier ou manifeste, avance minutée, aléatoire ou par boutons.
+# Sans manifeste utilisable, retour aux images intégrées.
+manifestPath = '/home/emile/selection/diaporama.txt'
+defaultImages = ['MAIS.BMP', 'KID.BMP', 'ZEN.BMP']
+maxSkippedImages = 10
+
+def makePlaylist(source):
+    return playlist.Playlist(source, mode='buttons', interval=30.0, prepare=partial(displayImageFrame, 0, 0))
+
+images = makePlaylist(manifestPath if os.path.isfile(manifestPath) else defaultImages)
+
+# Affect screen with IMAGE : l'image suivante est déjà préparée, une trame displayImage puis refresh
+# seulement si le module l'a acceptée
+def wakeUpandUpdate(frame):
+    # Le clear évite qu'une image plus petite que l'écran laisse voir la précédente
     wakeup()
     clear()
-    displayImage(0, 0, images[index])
-    refresh()
+    shown = transactOnSerial(frame) == bytearray(b'OK')
+    if shown:
+        refresh()
     sleep()
+    return shown
+
+def nextFrame(action):
+    global images
+    try:
+        return action()
+    except (OSError, ValueError) as error:
+        print("Diaporama :", error, "- retour aux images integrees")
+        mode = images.mode
+        images = makePlaylist(defaultImages)
+        images.mode = mode
+        return images.rewind()
+
+def showStep(step):
+    # Une image que le module refuse est sautée
+    for attempt in range(maxSkippedImages):
+        if wakeUpandUpdate(nextFrame(lambda: images.advance(step))):
+            return
 
 # Callback
-pictureIndex = 0
+# Arrière et avant : image précédente ou suivante. Go : bascule entre avance par boutons et minutée
+pendingStep = 0
 def shortLongCallback(channel):
+    global pendingStep
+
     misses = 0
     for i in range(10):
         if GPIO.input(channel) == 1:
@@ -236,13 +276,12 @@ def shortLongCallback(channel):
             # Short
             # events.append('short' + str(channel))
             if channel == backBTN_GPIO:
-                global pictureIndex 
-                pictureIndex = 0
+                pendingStep = -1
             else:
                 if channel == fwdBTN_GPIO:
-                    pictureIndex = 1
+                    pendingStep = 1
                 else:
-                    pictureIndex = 2
+                    images.setMode('sequence' if images.mode == 'buttons' else 'buttons')
             return
         else:
             time.sleep(0.1)
@@ -271,14 +310,14 @@ def signal_handler(sig, frame):
     sys.exit(0)
 signal.signal(signal.SIGINT, signal_handler)
 
-oldIndex = 555
+if not wakeUpandUpdate(nextFrame(lambda: images.rewind())):
+    showStep(1)
 while True:
-    if oldIndex != pictureIndex:
-        wakeUpandUpdate(pictureIndex)
-        oldIndex = pictureIndex
-
-    time.sleep(1)
+    if pendingStep != 0:
+        step = pendingStep
+        pendingStep = 0
+        showStep(step)
+    elif images.due():
+        showStep(1)
 
-#    indexInList += 1
-#    if indexInList == len(images):
-#        indexInList = 0
+    time.sleep(0.25)